@@ -4,13 +4,254 @@ Generate 100 sample photos with varying file sizes averaging 2MB.
 Supports JPEG, PNG, and WebP formats.
 """
 
+import gc
+import io
 import os
 import random
 import math
-from PIL import Image, ImageDraw, ImageFont
+import sys
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from PIL import Image, ImageFont
 import numpy as np
 
-def generate_image_with_target_size(target_size_bytes, output_path, format='JPEG'):
+# File extension for each supported format
+_EXT_MAP = {'JPEG': 'jpg', 'PNG': 'png', 'WEBP': 'webp'}
+
+# Encoder settings, pinned explicitly so Pillow default changes can't bring
+# back slow passes: no Huffman optimisation or progressive scans for JPEG,
+# fast deflate for PNG, and libwebp's default effort level (method=4 is
+# roughly twice as fast as 6 for little size difference)
+_JPEG_KW = dict(optimize=False, progressive=False)
+_PNG_KW = dict(optimize=False, compress_level=1)
+_WEBP_KW = dict(method=4, lossless=False)
+_SAVE_KW = {'JPEG': _JPEG_KW, 'PNG': _PNG_KW, 'WEBP': _WEBP_KW}
+
+# Write buffer for output files; large enough to take the biggest (~4MB)
+# encoded image in a single sequential write
+_WRITE_BUFFER = 4 * 1024 * 1024
+
+# Number of progress lines buffered before writing them out together
+_PROGRESS_BATCH = 10
+
+# Calibrated encoded bytes per pixel, keyed by (format, quality)
+_BPP_CACHE = {}
+
+
+class RunningStats:
+    """
+    Running count, total, mean, min, max and standard deviation of a stream
+    of values, kept in constant memory using Welford's algorithm.
+    """
+    
+    __slots__ = ('n', 'mean', 'M2', 'mn', 'mx', 'total')
+    
+    def __init__(self):
+        self.n = 0
+        self.mean = 0.0
+        self.M2 = 0.0
+        self.mn = 0
+        self.mx = 0
+        self.total = 0
+    
+    def update(self, x):
+        """Add one value to the running statistics."""
+        self.n += 1
+        self.total += x
+        delta = x - self.mean
+        self.mean += delta / self.n
+        self.M2 += delta * (x - self.mean)
+        if self.n == 1:
+            self.mn = self.mx = x
+        else:
+            self.mn = min(self.mn, x)
+            self.mx = max(self.mx, x)
+    
+    @property
+    def std(self):
+        """Population standard deviation of the values seen so far."""
+        return math.sqrt(self.M2 / self.n) if self.n else 0.0
+
+
+def random_tile_pixels(width, height, step, rng):
+    """
+    Build an RGB pixel buffer filled with randomly colored square tiles.
+    
+    Args:
+        width: Image width in pixels
+        height: Image height in pixels
+        step: Tile edge length in pixels
+        rng: numpy.random.Generator to draw colors from
+    
+    Returns:
+        uint8 array of shape (height, width, 3)
+    """
+    # One random color per tile, then upscale each tile to step x step pixels.
+    # The last row/column of tiles is repeated only as far as the edge, so the
+    # result comes out at exactly (height, width) and C-contiguous; a cropped
+    # view would make Image.fromarray take another full copy.
+    rows = -(-height // step)
+    cols = -(-width // step)
+    tiles = rng.integers(0, 256, size=(rows, cols, 3), dtype=np.uint8)
+    row_counts = np.full(rows, step)
+    row_counts[-1] = height - step * (rows - 1)
+    col_counts = np.full(cols, step)
+    col_counts[-1] = width - step * (cols - 1)
+    return tiles.repeat(row_counts, axis=0).repeat(col_counts, axis=1)
+
+
+def draw_random_ellipses(pixels, rng, count=20):
+    """
+    Paint randomly placed, randomly colored filled ellipses onto a pixel buffer.
+    
+    Args:
+        pixels: uint8 array of shape (height, width, 3), modified in place
+        rng: numpy.random.Generator to draw positions, sizes and colors from
+        count: Number of ellipses to draw
+    """
+    height, width = pixels.shape[:2]
+    
+    # Sample every ellipse's parameters up front in a few batched calls
+    origins = rng.integers(0, [max(1, width - 100), max(1, height - 100)], size=(count, 2), endpoint=True)
+    extents = rng.integers(50, 200, size=(count, 2), endpoint=True)
+    colors = rng.integers(0, 256, size=(count, 3), dtype=np.uint8)
+    
+    for (x1, y1), (dx, dy), color in zip(origins.tolist(), extents.tolist(), colors):
+        x2 = min(x1 + dx, width)
+        y2 = min(y1 + dy, height)
+        
+        # Test pixel centres against the ellipse inscribed in the bounding box
+        cx, cy = (x1 + x2) / 2, (y1 + y2) / 2
+        rx, ry = (x2 - x1) / 2, (y2 - y1) / 2
+        yy, xx = np.ogrid[y1:y2, x1:x2]
+        mask = ((xx + 0.5 - cx) / rx) ** 2 + ((yy + 0.5 - cy) / ry) ** 2 <= 1
+        pixels[y1:y2, x1:x2][mask] = color
+
+
+def estimate_bytes_per_pixel(format, quality, step=50):
+    """
+    Measure how many encoded bytes a pixel of the tile pattern costs.
+    
+    Encodes a 512x512 calibration tile in memory once per (format, quality)
+    and caches the result for subsequent calls.
+    
+    Args:
+        format: Image format ('JPEG', 'PNG', 'WEBP')
+        quality: Encoder quality setting
+        step: Tile edge length of the pattern in pixels
+    """
+    key = (format, quality)
+    if key not in _BPP_CACHE:
+        side = 512
+        buf = io.BytesIO()
+        # Fixed seed so the estimate is the same in every worker process
+        img = Image.fromarray(random_tile_pixels(side, side, step, np.random.default_rng(0)))
+        img.save(buf, format=format, quality=quality, **_SAVE_KW[format])
+        _BPP_CACHE[key] = len(buf.getvalue()) / (side * side)
+    return _BPP_CACHE[key]
+
+
+def _write_encoded(buf, output_path):
+    """Write an encoded image buffer to disk; returns the number of bytes written."""
+    # Single write straight to the final path; leave flushing to the OS.
+    # Encoders never hand Pillow the file itself, which would trickle the
+    # image out in many small writes.
+    with open(output_path, 'wb', buffering=_WRITE_BUFFER) as f:
+        return f.write(buf.getbuffer())
+
+
+def _encode_jpeg(target_size_bytes, output_path, rng):
+    """Generate a JPEG near the target size; returns the size written."""
+    # At a fixed quality, JPEG size scales roughly linearly with pixel
+    # count, so solve for the dimensions up front and encode once
+    quality = 85
+    bytes_per_pixel = estimate_bytes_per_pixel('JPEG', quality)
+    base_width = max(200, int(math.sqrt(target_size_bytes / bytes_per_pixel)))
+    base_height = base_width
+    
+    # Create a colorful pattern to increase file size
+    pixels = random_tile_pixels(base_width, base_height, 50, rng)
+    
+    # Add some graphics to increase complexity
+    draw_random_ellipses(pixels, rng)
+    img = Image.fromarray(pixels)
+    
+    # Encode in memory so only the chosen result touches the disk
+    buf = io.BytesIO()
+    img.save(buf, format='JPEG', quality=quality, **_JPEG_KW)
+    file_size = buf.tell()
+    
+    # One corrective re-encode if the estimate missed by more than 15%
+    if abs(file_size - target_size_bytes) / target_size_bytes > 0.15:
+        scale_factor = math.sqrt(target_size_bytes / file_size)
+        base_width = int(base_width * scale_factor)
+        base_height = int(base_height * scale_factor)
+        # Nearest-neighbour keeps the block structure and avoids a repaint
+        img = img.resize((base_width, base_height), Image.Resampling.NEAREST)
+        buf = io.BytesIO()
+        img.save(buf, format='JPEG', quality=quality, **_JPEG_KW)
+        file_size = buf.tell()
+    
+    return _write_encoded(buf, output_path)
+
+
+def _encode_png(target_size_bytes, output_path, rng):
+    """Generate a PNG near the target size; returns the size written."""
+    # PNG is less compressible, needs more pixels. _PNG_KW keeps the
+    # deflate pass cheap; a bigger file is fine since we're chasing a
+    # target size anyway.
+    base_width = 900
+    base_height = 900
+    
+    # Create complex pattern
+    img = Image.fromarray(random_tile_pixels(base_width, base_height, 30, rng))
+    
+    buf = io.BytesIO()
+    img.save(buf, format='PNG', **_PNG_KW)
+    file_size = buf.tell()
+    
+    # Adjust if needed. Rebuild the pattern at the new size with the same
+    # tile size rather than resampling the probe: a flat-tile PNG's size
+    # scales with the number of tiles, so stretching the tiles (nearest) falls
+    # well short of the target, and LANCZOS is slow and overshoots it.
+    if file_size < target_size_bytes:
+        scale = math.sqrt(target_size_bytes / file_size)
+        new_width = int(base_width * scale)
+        new_height = int(base_height * scale)
+        img = Image.fromarray(random_tile_pixels(new_width, new_height, 30, rng))
+        buf = io.BytesIO()
+        img.save(buf, format='PNG', **_PNG_KW)
+    
+    return _write_encoded(buf, output_path)
+
+
+def _encode_webp(target_size_bytes, output_path, rng):
+    """Generate a WebP near the target size; returns the size written."""
+    # WebP similar to JPEG
+    base_width = 2000
+    base_height = 2000
+    
+    pixels = random_tile_pixels(base_width, base_height, 50, rng)
+    
+    # Add complexity
+    draw_random_ellipses(pixels, rng)
+    img = Image.fromarray(pixels)
+    
+    # Try different quality levels
+    for quality in range(95, 60, -5):
+        buf = io.BytesIO()
+        img.save(buf, format='WEBP', quality=quality, **_WEBP_KW)
+        file_size = buf.getbuffer().nbytes
+        if abs(file_size - target_size_bytes) / target_size_bytes < 0.15:
+            break
+    
+    return _write_encoded(buf, output_path)
+
+
+# Encoder for each supported format
+_RENDERERS = {'JPEG': _encode_jpeg, 'PNG': _encode_png, 'WEBP': _encode_webp}
+
+
+def generate_image_with_target_size(target_size_bytes, output_path, format='JPEG', rng=None):
     """
     Generate an image that approximates the target file size.
     
@@ -18,150 +259,70 @@ def generate_image_with_target_size(target_size_bytes, output_path, format='JPEG
         target_size_bytes: Target file size in bytes
         output_path: Path to save the image
         format: Image format ('JPEG', 'PNG', 'WEBP')
+        rng: numpy.random.Generator to use; a fresh unseeded one if None
+    
+    Returns:
+        Size of the written file in bytes
     """
-    # Estimate dimensions needed for target size
-    # JPEG: roughly 0.5-2 bytes per pixel depending on quality
-    # PNG: varies widely, typically 1-4 bytes per pixel
-    # WebP: similar to JPEG
+    if format not in _RENDERERS:
+        raise ValueError(f"Unsupported format: {format}")
+    if rng is None:
+        rng = np.random.default_rng()
     
-    if format == 'JPEG':
-        # JPEG compression: quality affects size significantly
-        # Start with reasonable dimensions and adjust quality
-        base_width = 2000
-        base_height = 2000
-        
-        # Try different quality levels
-        for quality in range(95, 60, -5):
-            img = Image.new('RGB', (base_width, base_height))
-            draw = ImageDraw.Draw(img)
-            
-            # Create a colorful pattern to increase file size
-            for i in range(0, base_width, 50):
-                for j in range(0, base_height, 50):
-                    color = (
-                        random.randint(0, 255),
-                        random.randint(0, 255),
-                        random.randint(0, 255)
-                    )
-                    draw.rectangle([i, j, i+50, j+50], fill=color)
-            
-            # Add some text/graphics to increase complexity
-            for _ in range(20):
-                x1 = random.randint(0, base_width - 100)
-                y1 = random.randint(0, base_height - 100)
-                x2 = x1 + random.randint(50, 200)
-                y2 = y1 + random.randint(50, 200)
-                color = (random.randint(0, 255), random.randint(0, 255), random.randint(0, 255))
-                draw.ellipse([x1, y1, x2, y2], fill=color)
-            
-            temp_path = output_path + '.tmp'
-            img.save(temp_path, format='JPEG', quality=quality, optimize=False)
-            
-            file_size = os.path.getsize(temp_path)
-            
-            # If we're close enough (within 10%), use it
-            if abs(file_size - target_size_bytes) / target_size_bytes < 0.1:
-                os.rename(temp_path, output_path)
-                return file_size
-            
-            # If too small, increase dimensions
-            if file_size < target_size_bytes * 0.9:
-                scale_factor = math.sqrt(target_size_bytes / file_size)
-                base_width = int(base_width * scale_factor)
-                base_height = int(base_height * scale_factor)
-                continue
-            
-            # If too large but close, adjust quality more finely
-            if file_size > target_size_bytes:
-                # Try slightly lower quality
-                for q in range(quality - 1, max(60, quality - 6), -1):
-                    img.save(temp_path, format='JPEG', quality=q, optimize=False)
-                    file_size = os.path.getsize(temp_path)
-                    if file_size <= target_size_bytes * 1.1:
-                        os.rename(temp_path, output_path)
-                        return file_size
-                # If still too large, reduce dimensions
-                scale_factor = math.sqrt(target_size_bytes / file_size)
-                base_width = int(base_width * scale_factor)
-                base_height = int(base_height * scale_factor)
-        
-        # Final attempt with calculated dimensions
-        img = Image.new('RGB', (base_width, base_height))
-        draw = ImageDraw.Draw(img)
-        for i in range(0, base_width, 50):
-            for j in range(0, base_height, 50):
-                color = (random.randint(0, 255), random.randint(0, 255), random.randint(0, 255))
-                draw.rectangle([i, j, min(i+50, base_width), min(j+50, base_height)], fill=color)
-        
-        # Add complexity with ellipses
-        for _ in range(20):
-            x1 = random.randint(0, max(1, base_width - 100))
-            y1 = random.randint(0, max(1, base_height - 100))
-            x2 = min(x1 + random.randint(50, 200), base_width)
-            y2 = min(y1 + random.randint(50, 200), base_height)
-            color = (random.randint(0, 255), random.randint(0, 255), random.randint(0, 255))
-            draw.ellipse([x1, y1, x2, y2], fill=color)
-        
-        img.save(output_path, format='JPEG', quality=85, optimize=False)
-        return os.path.getsize(output_path)
+    return _RENDERERS[format](target_size_bytes, output_path, rng)
+
+
+def truncated_normal(rng, mean, std_dev, low, high, size, max_rounds=100):
+    """
+    Sample a normal distribution truncated to [low, high] by rejection.
     
-    elif format == 'PNG':
-        # PNG is less compressible, needs more pixels
-        base_width = 1500
-        base_height = 1500
-        
-        img = Image.new('RGB', (base_width, base_height))
-        draw = ImageDraw.Draw(img)
-        
-        # Create complex pattern
-        for i in range(0, base_width, 30):
-            for j in range(0, base_height, 30):
-                color = (random.randint(0, 255), random.randint(0, 255), random.randint(0, 255))
-                draw.rectangle([i, j, i+30, j+30], fill=color)
-        
-        img.save(output_path, format='PNG', optimize=False)
-        file_size = os.path.getsize(output_path)
-        
-        # Adjust if needed
-        if file_size < target_size_bytes:
-            scale = math.sqrt(target_size_bytes / file_size)
-            new_width = int(base_width * scale)
-            new_height = int(base_height * scale)
-            img = img.resize((new_width, new_height), Image.Resampling.LANCZOS)
-            img.save(output_path, format='PNG', optimize=False)
-        
-        return os.path.getsize(output_path)
+    Unlike clipping, this doesn't pile samples up on the bounds, so no
+    rescaling pass is needed afterwards.
     
-    elif format == 'WEBP':
-        # WebP similar to JPEG
-        base_width = 2000
-        base_height = 2000
-        
-        img = Image.new('RGB', (base_width, base_height))
-        draw = ImageDraw.Draw(img)
-        
-        for i in range(0, base_width, 50):
-            for j in range(0, base_height, 50):
-                color = (random.randint(0, 255), random.randint(0, 255), random.randint(0, 255))
-                draw.rectangle([i, j, min(i+50, base_width), min(j+50, base_height)], fill=color)
-        
-        # Add complexity
-        for _ in range(20):
-            x1 = random.randint(0, max(1, base_width - 100))
-            y1 = random.randint(0, max(1, base_height - 100))
-            x2 = min(x1 + random.randint(50, 200), base_width)
-            y2 = min(y1 + random.randint(50, 200), base_height)
-            color = (random.randint(0, 255), random.randint(0, 255), random.randint(0, 255))
-            draw.ellipse([x1, y1, x2, y2], fill=color)
-        
-        # Try different quality levels
-        for quality in range(95, 60, -5):
-            img.save(output_path, format='WEBP', quality=quality, method=6)
-            file_size = os.path.getsize(output_path)
-            if abs(file_size - target_size_bytes) / target_size_bytes < 0.15:
-                return file_size
-        
-        return os.path.getsize(output_path)
+    Args:
+        rng: numpy.random.Generator to draw from
+        mean: Mean of the underlying normal distribution
+        std_dev: Standard deviation of the underlying normal distribution
+        low: Lower bound (inclusive)
+        high: Upper bound (inclusive)
+        size: Number of samples to return
+        max_rounds: Batches to try before clipping whatever is still missing
+    """
+    samples = np.empty(0)
+    for _ in range(max_rounds):
+        draws = rng.normal(mean, std_dev, 2 * size)
+        samples = np.concatenate([samples, draws[(draws >= low) & (draws <= high)]])
+        if samples.size >= size:
+            return samples[:size]
+    
+    # Bounds sit far out in a tail; fall back to clipping the remainder
+    missing = size - samples.size
+    return np.concatenate([samples, np.clip(rng.normal(mean, std_dev, missing), low, high)])
+
+
+def _generate_one(args):
+    """
+    Generate a single photo in a worker process.
+    
+    Args:
+        args: Tuple of (index, target_size, format_type, output_path)
+    
+    Returns:
+        Tuple of (filename, actual_size)
+    """
+    i, target_size, format_type, output_path = args
+    
+    # Seed per photo so results don't depend on which worker picks it up
+    rng = np.random.default_rng(i)
+    
+    # Nothing here creates reference cycles; skip the cyclic GC while the
+    # short-lived images and buffers churn
+    gc.disable()
+    try:
+        actual_size = generate_image_with_target_size(target_size, output_path, format_type, rng)
+    finally:
+        gc.enable()
+    return os.path.basename(output_path), actual_size
 
 
 def generate_sample_photos(output_dir='sample_photos', num_photos=100, avg_size_mb=2):
@@ -179,70 +340,79 @@ def generate_sample_photos(output_dir='sample_photos', num_photos=100, avg_size_
     total_size_bytes = avg_size_bytes * num_photos
     
     # Generate sizes using a normal distribution around the average
-    # with some variation (std dev of 30% of average)
+    # with some variation (std dev of 30% of average), truncated to
+    # reasonable bounds (0.5MB to 4MB to stay within 10MB limit)
     std_dev = avg_size_bytes * 0.3
-    sizes = np.random.normal(avg_size_bytes, std_dev, num_photos)
-    
-    # Clamp sizes to reasonable bounds (0.5MB to 4MB to stay within 10MB limit)
     min_size = 0.5 * 1024 * 1024
     max_size = 4 * 1024 * 1024
-    sizes = np.clip(sizes, min_size, max_size)
-    
-    # Adjust to ensure exact average
-    current_avg = np.mean(sizes)
-    adjustment_factor = avg_size_bytes / current_avg
-    sizes = sizes * adjustment_factor
+    sizes = truncated_normal(np.random.default_rng(), avg_size_bytes, std_dev,
+                             min_size, max_size, num_photos)
     
     # Format distribution: 70% JPEG, 20% PNG, 10% WebP
     formats = ['JPEG'] * 70 + ['PNG'] * 20 + ['WEBP'] * 10
     random.shuffle(formats)
     
-    total_generated = 0
-    file_sizes = []
+    stats = RunningStats()
     
     print(f"Generating {num_photos} sample photos averaging {avg_size_mb}MB...")
     print(f"Output directory: {output_dir}\n")
     
-    for i in range(num_photos):
-        target_size = int(sizes[i])
-        format_type = formats[i]
-        
-        # Determine file extension
-        ext_map = {'JPEG': 'jpg', 'PNG': 'png', 'WEBP': 'webp'}
-        ext = ext_map[format_type]
-        
-        filename = f"sample_photo_{i+1:03d}.{ext}"
-        output_path = os.path.join(output_dir, filename)
-        
-        print(f"Generating {i+1}/{num_photos}: {filename} (target: {target_size/1024/1024:.2f}MB, format: {format_type})", end='')
-        
-        try:
-            actual_size = generate_image_with_target_size(target_size, output_path, format_type)
-            file_sizes.append(actual_size)
-            total_generated += actual_size
+    targets = sizes.astype(np.int64)
+    paths = [
+        os.path.join(output_dir, f"sample_photo_{i+1:03d}.{_EXT_MAP[format_type]}")
+        for i, format_type in enumerate(formats[:num_photos])
+    ]
+    tasks = [
+        (i, int(targets[i]), formats[i], paths[i])
+        for i in range(num_photos)
+    ]
+    
+    # Progress lines are written in batches rather than flushed per photo
+    pending = []
+    
+    gc.disable()
+    try:
+        # Each photo is independent and CPU-bound, so spread them across cores
+        with ProcessPoolExecutor(max_workers=os.cpu_count()) as executor:
+            futures = {executor.submit(_generate_one, task): task for task in tasks}
             
-            actual_mb = actual_size / 1024 / 1024
-            print(f" -> {actual_mb:.2f}MB")
-        except Exception as e:
-            print(f" -> ERROR: {e}")
-            if os.path.exists(output_path):
-                os.remove(output_path)
+            for done, future in enumerate(as_completed(futures), start=1):
+                _, target_size, format_type, output_path = futures[future]
+                filename = os.path.basename(output_path)
+                status = f"Generated {done}/{num_photos}: {filename} (target: {target_size/1024/1024:.2f}MB, format: {format_type})"
+                
+                try:
+                    _, actual_size = future.result()
+                    stats.update(actual_size)
+                    
+                    actual_mb = actual_size / 1024 / 1024
+                    pending.append(f"{status} -> {actual_mb:.2f}MB")
+                except Exception as e:
+                    pending.append(f"{status} -> ERROR: {e}")
+                    if os.path.exists(output_path):
+                        os.remove(output_path)
+                
+                if len(pending) >= _PROGRESS_BATCH or done == num_photos:
+                    sys.stdout.write('\n'.join(pending) + '\n')
+                    sys.stdout.flush()
+                    pending.clear()
+    finally:
+        gc.enable()
+        gc.collect()
     
     # Summary
     print("\n" + "="*60)
     print("Generation Summary:")
-    print(f"  Total photos generated: {len(file_sizes)}")
-    print(f"  Total size: {total_generated / 1024 / 1024:.2f} MB")
-    print(f"  Average size: {np.mean(file_sizes) / 1024 / 1024:.2f} MB")
-    print(f"  Min size: {min(file_sizes) / 1024 / 1024:.2f} MB")
-    print(f"  Max size: {max(file_sizes) / 1024 / 1024:.2f} MB")
-    print(f"  Std deviation: {np.std(file_sizes) / 1024 / 1024:.2f} MB")
+    print(f"  Total photos generated: {stats.n}")
+    print(f"  Total size: {stats.total / 1024 / 1024:.2f} MB")
+    print(f"  Average size: {stats.mean / 1024 / 1024:.2f} MB")
+    print(f"  Min size: {stats.mn / 1024 / 1024:.2f} MB")
+    print(f"  Max size: {stats.mx / 1024 / 1024:.2f} MB")
+    print(f"  Std deviation: {stats.std / 1024 / 1024:.2f} MB")
     print("="*60)
 
 
 if __name__ == '__main__':
-    import sys
-    
     output_dir = sys.argv[1] if len(sys.argv) > 1 else 'sample_photos'
     num_photos = int(sys.argv[2]) if len(sys.argv) > 2 else 100
     avg_size_mb = float(sys.argv[3]) if len(sys.argv) > 3 else 2.0